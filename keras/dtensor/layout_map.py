@@ -18,6 +18,9 @@ from tensorflow.dtensor import python as dtensor  # pylint: disable=g-direct-ten
 _KERAS_ATTRIBUTES_TO_SKIP = ['_self_tracked_trackables', '_trainable_weights',
                              '_non_trainable_weights']
 
+# Max number of the resolved layouts cached by the LayoutMap.
+_RESOLVE_CACHE_SIZE = 4096
+
 
 class LayoutMap(collections.MutableMapping):
 
@@ -32,8 +35,25 @@ class LayoutMap(collections.MutableMapping):
         layout as default when there isn't a layout is found based on the
         mapping.
     """
-    self._layout_map = collections.OrderedDict()
+    # The keys, their compiled regex and layouts are stored in parallel lists
+    # based on the insertion order, and the index of each key in the lists is
+    # kept in self._key_to_index for the exact match.
+    self._keys = []
+    self._patterns = []
+    self._layouts = []
+    self._key_to_index = {}
+    # Index over the keys for the regex lookup, lazily built on lookup and
+    # reset on mutation. See _build_index() for more details.
+    self._index_built = False
+    self._literal_keys = {}
+    self._literal_key_lengths = []
+    self._regex_key_indices = []
+    self._combined_pattern = None
     self._default_mesh = mesh
+    # Cache the resolved layout for each query, since the same variable path
+    # could be looked up multiple times. Needs to be cleared when the map is
+    # mutated.
+    self._resolve_cache = {}
 
   def __getitem__(self, key):
     """Retrieve the corresponding layout by the string key.
@@ -49,34 +69,132 @@ class LayoutMap(collections.MutableMapping):
     Returns:
       Corresponding layout based on the query.
     """
-    if key in self._layout_map:
-      return self._layout_map[key]
-
-    for k in self._layout_map:
-      if re.match(k, key):
-        return self._layout_map[k]
-    return None
+    if key in self._resolve_cache:
+      return self._resolve_cache[key]
+    layout = self._resolve(key)
+    if len(self._resolve_cache) >= _RESOLVE_CACHE_SIZE:
+      self._resolve_cache.clear()
+    self._resolve_cache[key] = layout
+    return layout
+
+  def _resolve(self, key):
+    index = self._key_to_index.get(key)
+    if index is not None:
+      return self._layouts[index]
+
+    if not self._index_built:
+      self._build_index()
+      self._index_built = True
+
+    # The index of the first key that matches.
+    first_match = None
+    for length in self._literal_key_lengths:
+      if length > len(key):
+        break
+      index = self._literal_keys.get(key[:length])
+      if index is not None and (first_match is None or index < first_match):
+        first_match = index
+
+    if self._combined_pattern is not None:
+      match = self._combined_pattern.match(key)
+      if match is not None:
+        # The alternatives are tried in the insertion order, and each of them
+        # is the only capturing group in its branch.
+        index = self._regex_key_indices[match.lastindex - 1]
+        if first_match is None or index < first_match:
+          first_match = index
+    else:
+      for index in self._regex_key_indices:
+        if first_match is not None and index > first_match:
+          break
+        if self._patterns[index].match(key):
+          first_match = index
+          break
+
+    if first_match is None:
+      return None
+    return self._layouts[first_match]
+
+  def _build_index(self):
+    """Build the index used by the regex lookup.
+
+    Keys without any regex special character can only match the queries that
+    start with them. They are stored in a dict, and matched by probing the
+    prefixes of the query with the same lengths.
+
+    The rest of the keys are combined into a single alternation regex
+    `(k0)|(k1)|...`, so that the query is scanned once in the regex engine
+    rather than looping over the patterns in python. Combining is skipped when
+    any of the key has its own capturing groups or inline flags, since those
+    would change the group numbering or the flags of the other keys.
+    """
+    self._literal_keys = {}
+    self._regex_key_indices = []
+    for index, key in enumerate(self._keys):
+      if self._patterns[index] is None:
+        continue
+      if re.escape(key) == key:
+        self._literal_keys[key] = index
+      else:
+        self._regex_key_indices.append(index)
+    self._literal_key_lengths = sorted(set(map(len, self._literal_keys)))
+
+    self._combined_pattern = None
+    if not self._regex_key_indices:
+      return
+    default_flags = re.compile('').flags
+    for index in self._regex_key_indices:
+      pattern = self._patterns[index]
+      if pattern.groups or pattern.flags != default_flags:
+        return
+    try:
+      self._combined_pattern = re.compile(
+          '|'.join(f'({self._keys[i]})' for i in self._regex_key_indices))
+    except re.error:
+      pass
+
+  def _reset_cache(self):
+    self._index_built = False
+    self._resolve_cache.clear()
 
   def __setitem__(self, key, layout):
-    if key in self._layout_map:
+    if key in self._key_to_index:
       raise ValueError(f'{key} already exist in the LayoutMap with '
-                       f'value {self._layout_map[key]}. Please make sure to '
-                       'not use duplicated keys.')
+                       f'value {self._layouts[self._key_to_index[key]]}. '
+                       'Please make sure to not use duplicated keys.')
     if not isinstance(layout, dtensor.Layout):
       raise ValueError(f'{layout} should be a dtensor.Layout type, '
                        'got {type(layout)}')
 
-    self._layout_map[key] = layout
+    try:
+      pattern = re.compile(key)
+    except re.error:
+      # Any string can be used as a key, and a key that isn't a valid regex
+      # will only be used for the exact match.
+      pattern = None
+    self._key_to_index[key] = len(self._keys)
+    self._keys.append(key)
+    self._patterns.append(pattern)
+    self._layouts.append(layout)
+    self._reset_cache()
 
   def __delitem__(self, key):
     # let the dict to handle the key missing error
-    return self._layout_map.pop(key)
+    index = self._key_to_index.pop(key)
+    layout = self._layouts[index]
+    del self._keys[index]
+    del self._patterns[index]
+    del self._layouts[index]
+    # Deletion is rare, just recompute the index for all the keys.
+    self._key_to_index = {k: i for i, k in enumerate(self._keys)}
+    self._reset_cache()
+    return layout
 
   def __len__(self):
-    return len(self._layout_map)
+    return len(self._keys)
 
   def __iter__(self):
-    return iter(self._layout_map)
+    return iter(self._keys)
 
   def get_default_mesh(self):
     return self._default_mesh
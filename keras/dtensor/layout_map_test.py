@@ -1,5 +1,7 @@
 """Tests for layout_map."""
 
+import copy
+
 from keras import backend
 from keras import layers
 from keras.dtensor import layout_map as layout_map_lib
@@ -13,24 +15,31 @@ from tensorflow.dtensor import python as dtensor  # pylint: disable=g-direct-ten
 
 class LayoutMapTest(test_util.DTensorBaseTest):
 
-  def setUp(self):
-    super(LayoutMapTest, self).setUp()
-    backend.enable_tf_random_generator()
-    tf_utils.set_random_seed(1337)
-    global_ids = test_util.create_device_ids_array((2, 2))
-    local_device_ids = np.ravel(global_ids).tolist()
-    mesh_dict = {
+  @classmethod
+  def setUpClass(cls):
+    super(LayoutMapTest, cls).setUpClass()
+    # The mesh and layouts are the same for all the tests, only build them once.
+    global_ids = np.arange(4, dtype=np.int64).reshape((2, 2))
+    local_device_ids = global_ids.ravel().tolist()
+    cls.mesh_dict = {
         'CPU':
             dtensor.Mesh(['X', 'Y'], global_ids,
                          local_device_ids,
                          test_util.create_device_list((2, 2), 'CPU'))
     }
-    self.mesh = self.configTestMesh(mesh_dict)
-    self.layout_2d = dtensor.Layout.replicated(self.mesh, rank=2)
-    self.layout_1d = dtensor.Layout.replicated(self.mesh, rank=1)
+    cls.mesh = cls.mesh_dict['CPU']
+    cls.layout_2d = dtensor.Layout.replicated(cls.mesh, rank=2)
+    cls.layout_1d = dtensor.Layout.replicated(cls.mesh, rank=1)
 
-    self.sharded_2d = dtensor.Layout.batch_sharded(self.mesh, 'X', rank=2)
-    self.sharded_1d = dtensor.Layout.batch_sharded(self.mesh, 'X', rank=1)
+    cls.sharded_2d = dtensor.Layout.batch_sharded(cls.mesh, 'X', rank=2)
+    cls.sharded_1d = dtensor.Layout.batch_sharded(cls.mesh, 'X', rank=1)
+
+  def setUp(self):
+    super(LayoutMapTest, self).setUp()
+    backend.enable_tf_random_generator()
+    tf_utils.set_random_seed(1337)
+    # The test devices are reset between tests, so configure them for each test.
+    self.configTestMesh(self.mesh_dict)
 
   def test_add(self):
     layout_map = layout_map_lib.LayoutMap()
@@ -39,10 +48,9 @@ class LayoutMapTest(test_util.DTensorBaseTest):
     layout_map['dense/bias'] = self.layout_1d
 
     # Make there are two items in the map, and we access them via the
-    # underlying container at layout_map._layout_map
-    self.assertLen(layout_map._layout_map, 2)
-    self.assertEqual(layout_map._layout_map['dense/kernel'], self.layout_2d)
-    self.assertEqual(layout_map._layout_map['dense/bias'], self.layout_1d)
+    # underlying containers at layout_map._keys and layout_map._layouts
+    self.assertEqual(layout_map._keys, ['dense/kernel', 'dense/bias'])
+    self.assertEqual(layout_map._layouts, [self.layout_2d, self.layout_1d])
 
     with self.assertRaisesRegex(ValueError, 'dense/kernel already exist'):
       layout_map['dense/kernel'] = self.layout_1d
@@ -72,6 +80,107 @@ class LayoutMapTest(test_util.DTensorBaseTest):
     self.assertIsNone(layout_map['conv2d/kernel'])
     self.assertEqual(layout_map['conv2d/bias'], self.sharded_1d)
 
+  def test_get_with_overlapping_regex(self):
+    layout_map = layout_map_lib.LayoutMap()
+
+    layout_map['dense.*'] = self.sharded_2d
+    layout_map['dense_1.*'] = self.layout_2d
+    layout_map['.*kernel'] = self.layout_1d
+
+    # All the keys are matched with the combined regex, and based on the order
+    # of insertion, the first matched key is used.
+    self.assertEqual(layout_map['dense_1/kernel'], self.sharded_2d)
+    self.assertEqual(layout_map['conv2d/kernel'], self.layout_1d)
+    self.assertIsNone(layout_map['conv2d/bias'])
+    self.assertIsNotNone(layout_map._combined_pattern)
+
+  def test_get_with_literal_prefix(self):
+    layout_map = layout_map_lib.LayoutMap()
+
+    layout_map['dense.*bias'] = self.layout_1d
+    layout_map['dense'] = self.sharded_2d
+
+    # The literal key matches the query as a prefix, but the regex key is
+    # inserted earlier.
+    self.assertEqual(layout_map['dense/bias'], self.layout_1d)
+    self.assertEqual(layout_map['dense/kernel'], self.sharded_2d)
+    # The query is shorter than all the literal keys.
+    self.assertIsNone(layout_map['de'])
+
+    layout_map = layout_map_lib.LayoutMap()
+
+    layout_map['dense'] = self.sharded_2d
+    layout_map['.*kernel'] = self.layout_2d
+
+    self.assertEqual(layout_map['dense_1/kernel'], self.sharded_2d)
+    self.assertEqual(layout_map['conv2d/kernel'], self.layout_2d)
+    self.assertIsNone(layout_map['conv2d/bias'])
+
+  def test_get_with_regex_groups_and_flags(self):
+    layout_map = layout_map_lib.LayoutMap()
+
+    layout_map['.*bias'] = self.sharded_1d
+    layout_map[r'(dense)_\d+/kernel'] = self.sharded_2d
+    layout_map['(?i)DENSE.*'] = self.layout_2d
+
+    # The keys with capturing groups or inline flags can't be combined, and
+    # they are matched one by one based on the order of insertion.
+    self.assertEqual(layout_map['dense_1/kernel'], self.sharded_2d)
+    self.assertEqual(layout_map['Dense_1/bias'], self.sharded_1d)
+    self.assertEqual(layout_map['Dense/kernel'], self.layout_2d)
+    self.assertIsNone(layout_map['conv2d/kernel'])
+    self.assertIsNone(layout_map._combined_pattern)
+
+  def test_get_with_invalid_regex_key(self):
+    layout_map = layout_map_lib.LayoutMap()
+
+    layout_map['dense[0'] = self.layout_2d
+    layout_map['dense.*'] = self.layout_1d
+
+    # The key that isn't a valid regex is only used for the exact match.
+    self.assertEqual(layout_map['dense[0'], self.layout_2d)
+    self.assertEqual(layout_map['dense[0/kernel'], self.layout_1d)
+    self.assertIsNone(layout_map['conv2d/kernel'])
+
+    # Also make sure it works with the per key regex lookup, when the regex
+    # keys can't be combined.
+    layout_map['(conv2d)/.*'] = self.sharded_2d
+    self.assertEqual(layout_map['dense[0/kernel'], self.layout_1d)
+    self.assertEqual(layout_map['conv2d/kernel'], self.sharded_2d)
+
+  def test_get_after_mutation(self):
+    layout_map = layout_map_lib.LayoutMap()
+
+    layout_map['dense/kernel'] = self.layout_2d
+    self.assertIsNone(layout_map['conv2d/bias'])
+
+    # Make sure the previous lookup result is not reused after the insertion.
+    layout_map['conv2d.*'] = self.sharded_1d
+    self.assertEqual(layout_map['conv2d/bias'], self.sharded_1d)
+
+    # Based on the order of insertion, it will still use conv2d.*.
+    layout_map['.*bias'] = self.layout_1d
+    self.assertEqual(layout_map['conv2d/bias'], self.sharded_1d)
+
+    # Fall back to the next matching key, and then no match after deletion.
+    del layout_map['conv2d.*']
+    self.assertEqual(layout_map['conv2d/bias'], self.layout_1d)
+    del layout_map['.*bias']
+    self.assertIsNone(layout_map['conv2d/bias'])
+
+  def test_deepcopy(self):
+    layout_map = layout_map_lib.LayoutMap()
+
+    layout_map['dense.*kernel'] = self.layout_2d
+    self.assertIsNone(layout_map['dense/bias'])
+
+    copied = copy.deepcopy(layout_map)
+    copied['dense.*bias'] = self.layout_1d
+    self.assertEqual(copied['dense/bias'], self.layout_1d)
+    self.assertEqual(copied['dense/kernel'], self.layout_2d)
+    # Make sure the original map is not affected.
+    self.assertIsNone(layout_map['dense/bias'])
+
   def test_delete(self):
     layout_map = layout_map_lib.LayoutMap()
 
@@ -86,7 +195,27 @@ class LayoutMapTest(test_util.DTensorBaseTest):
     # Make sure del also works
     del layout_map['dense/bias']
 
-    self.assertEmpty(layout_map._layout_map)
+    self.assertEmpty(layout_map._keys)
+    self.assertEmpty(layout_map._layouts)
+
+  def test_get_after_delete_middle_key(self):
+    layout_map = layout_map_lib.LayoutMap()
+
+    layout_map['dense/kernel'] = self.sharded_2d
+    layout_map['dense.*bias'] = self.sharded_1d
+    layout_map['dense.*kernel'] = self.layout_2d
+    layout_map['.*bias'] = self.layout_1d
+
+    del layout_map['dense.*bias']
+
+    # Make sure the keys after the deleted one still map to their layouts.
+    self.assertEqual(layout_map._keys,
+                     ['dense/kernel', 'dense.*kernel', '.*bias'])
+    self.assertEqual(layout_map['dense/kernel'], self.sharded_2d)
+    self.assertEqual(layout_map['dense.*kernel'], self.layout_2d)
+    self.assertEqual(layout_map['.*bias'], self.layout_1d)
+    self.assertEqual(layout_map['dense_1/kernel'], self.layout_2d)
+    self.assertEqual(layout_map['dense_1/bias'], self.layout_1d)
 
   def test_len(self):
     layout_map = layout_map_lib.LayoutMap()
@@ -106,11 +235,9 @@ class LayoutMapTest(test_util.DTensorBaseTest):
     # Make sure the items are ordered based on the insertion order.
     self.assertEqual(list(layout_map.keys()), ['dense/kernel', 'dense/bias'])
 
-    keys = []
-    values = []
-    for k, v in layout_map.items():
-      keys.append(k)
-      values.append(v)
+    items = list(layout_map.items())
+    keys = [k for k, _ in items]
+    values = [v for _, v in items]
 
     self.assertEqual(keys, ['dense/kernel', 'dense/bias'])
     self.assertEqual(values, [self.layout_2d, self.layout_1d])
@@ -133,32 +260,40 @@ class SubclassModel(tf.keras.Model):
 
 class ObjectPathMappingTest(test_util.DTensorBaseTest):
 
-  def setUp(self):
-    super(ObjectPathMappingTest, self).setUp()
-    backend.enable_tf_random_generator()
-    tf_utils.set_random_seed(1337)
-    global_ids = test_util.create_device_ids_array((2, 2))
-    local_device_ids = np.ravel(global_ids).tolist()
-    mesh_dict = {
+  @classmethod
+  def setUpClass(cls):
+    super(ObjectPathMappingTest, cls).setUpClass()
+    # The mesh and layouts are the same for all the tests, only build them once.
+    global_ids = np.arange(4, dtype=np.int64).reshape((2, 2))
+    local_device_ids = global_ids.ravel().tolist()
+    cls.mesh_dict = {
         'CPU':
             dtensor.Mesh(['X', 'Y'], global_ids,
                          local_device_ids,
                          test_util.create_device_list((2, 2), 'CPU'))
     }
-    self.mesh = self.configTestMesh(mesh_dict)
-    self.layout_2d = dtensor.Layout.replicated(self.mesh, rank=2)
-    self.layout_1d = dtensor.Layout.replicated(self.mesh, rank=1)
+    cls.mesh = cls.mesh_dict['CPU']
+    cls.layout_2d = dtensor.Layout.replicated(cls.mesh, rank=2)
+    cls.layout_1d = dtensor.Layout.replicated(cls.mesh, rank=1)
 
-    self.sharded_2d = dtensor.Layout.batch_sharded(self.mesh, 'X', rank=2)
-    self.sharded_1d = dtensor.Layout.batch_sharded(self.mesh, 'X', rank=1)
+    cls.sharded_2d = dtensor.Layout.batch_sharded(cls.mesh, 'X', rank=2)
+    cls.sharded_1d = dtensor.Layout.batch_sharded(cls.mesh, 'X', rank=1)
 
-  def test_init_subclass_model_variable_with_layout(self):
-    layout_map = layout_map_lib.LayoutMap(mesh=self.mesh)
-    layout_map['d1.kernel'] = self.layout_2d
-    layout_map['d1.bias'] = self.layout_1d
-    layout_map['d2.kernel'] = self.layout_2d
-    layout_map['d2.bias'] = self.layout_1d
+    # The layout map is only read by the tests, so it is shared among them.
+    cls.layout_map = layout_map_lib.LayoutMap(mesh=cls.mesh)
+    cls.layout_map['d1.kernel'] = cls.layout_2d
+    cls.layout_map['d1.bias'] = cls.layout_1d
+    cls.layout_map['d2.kernel'] = cls.layout_2d
+    cls.layout_map['d2.bias'] = cls.layout_1d
 
+  def setUp(self):
+    super(ObjectPathMappingTest, self).setUp()
+    backend.enable_tf_random_generator()
+    tf_utils.set_random_seed(1337)
+    # The test devices are reset between tests, so configure them for each test.
+    self.configTestMesh(self.mesh_dict)
+
+  def test_init_subclass_model_variable_with_layout(self):
     def model_init_fn():
       model = SubclassModel(name='model')
       inputs = tf.keras.Input((10,), batch_size=10)
@@ -166,7 +301,7 @@ class ObjectPathMappingTest(test_util.DTensorBaseTest):
       return model
 
     model_with_layout = layout_map_lib.init_model_with_layout_map(
-        layout_map, model_init_fn)
+        self.layout_map, model_init_fn)
     d1 = model_with_layout.d1
     d2 = model_with_layout.d2
     self.assertEqual(d1.kernel.layout, self.layout_2d)
@@ -183,19 +318,13 @@ class ObjectPathMappingTest(test_util.DTensorBaseTest):
 
     result = model_with_layout(tf.zeros((10, 10), layout=self.layout_2d),
                                training=True)
-    self.assertAllClose(result, tf.zeros((10, 1000), layout=self.layout_2d))
+    self.assertAllClose(result, np.zeros((10, 1000)))
 
   def test_init_functional_model_variable_with_layout(self):
     # Note that the functional model is using layers name + attribute name
     # the layer name are unique among the functional model, and when the layer
     # doesn't have a name, keras will give it a unique name based on the layer
     # class.
-    layout_map = layout_map_lib.LayoutMap(mesh=self.mesh)
-    layout_map['d1.kernel'] = self.layout_2d
-    layout_map['d1.bias'] = self.layout_1d
-    layout_map['d2.kernel'] = self.layout_2d
-    layout_map['d2.bias'] = self.layout_1d
-
     def model_init_fn():
       inputs = tf.keras.Input((10,), batch_size=10)
       x = layers.Dense(20, name='d1')(inputs)
@@ -206,7 +335,7 @@ class ObjectPathMappingTest(test_util.DTensorBaseTest):
       return model
 
     model_with_layout = layout_map_lib.init_model_with_layout_map(
-        layout_map, model_init_fn)
+        self.layout_map, model_init_fn)
     # It includes input layer as well.
     self.assertLen(model_with_layout.layers, 4)
     d1 = model_with_layout.layers[1]
@@ -226,19 +355,13 @@ class ObjectPathMappingTest(test_util.DTensorBaseTest):
 
     result = model_with_layout(tf.zeros((10, 10), layout=self.layout_2d),
                                training=True)
-    self.assertAllClose(result, tf.zeros((10, 30), layout=self.layout_2d))
+    self.assertAllClose(result, np.zeros((10, 30)))
 
   def test_init_sequential_model_variable_with_layout(self):
     # Note that the sequential model is using layers name + attribute name
     # the layer name are unique among the functional model, and when the layer
     # doesn't have a name, keras will give it a unique name based on the layer
     # class.
-    layout_map = layout_map_lib.LayoutMap(mesh=self.mesh)
-    layout_map['d1.kernel'] = self.layout_2d
-    layout_map['d1.bias'] = self.layout_1d
-    layout_map['d2.kernel'] = self.layout_2d
-    layout_map['d2.bias'] = self.layout_1d
-
     def model_init_fn():
       model = tf.keras.Sequential([
           layers.Dense(20, name='d1', input_shape=(10,)),
@@ -248,7 +371,7 @@ class ObjectPathMappingTest(test_util.DTensorBaseTest):
       return model
 
     model_with_layout = layout_map_lib.init_model_with_layout_map(
-        layout_map, model_init_fn)
+        self.layout_map, model_init_fn)
     self.assertLen(model_with_layout.layers, 3)
     d1 = model_with_layout.layers[0]
     d2 = model_with_layout.layers[2]
@@ -267,7 +390,7 @@ class ObjectPathMappingTest(test_util.DTensorBaseTest):
 
     result = model_with_layout(tf.zeros((10, 10), layout=self.layout_2d),
                                training=True)
-    self.assertAllClose(result, tf.zeros((10, 30), layout=self.layout_2d))
+    self.assertAllClose(result, np.zeros((10, 30)))
 
 
 if __name__ == '__main__':